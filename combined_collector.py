@@ -0,0 +1,183 @@
+"""
+Google Business Profile - Combined Impressions & Keywords Collection
+Cloud Function that performs a single location sweep and collects daily
+metrics and search keywords together, sharing auth and HTTP resources
+"""
+
+import asyncio
+import aiohttp
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from google.cloud import bigquery
+
+import daily_impressions
+import keywords_collector
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Configuration from environment variables
+PROJECT_ID = os.environ.get('GCP_PROJECT')
+DATASET_ID = os.environ.get('BQ_DATASET', 'google_business_profile')
+IMPRESSIONS_TABLE_ID = os.environ.get('BQ_TABLE_IMPRESSIONS', 'daily_impressions')
+
+
+async def collect_location(session, sem, queue, token_mgr, idx, total, location, start_date, end_date):
+    """Fetch metrics and keywords for one location, overlapping both calls"""
+    location_name = location['name']
+    location_title = location.get('title', 'N/A')
+
+    series, keywords = await asyncio.gather(
+        daily_impressions.fetch_metrics(session, sem, token_mgr, location_name,
+                                        start_date, end_date),
+        keywords_collector.fetch_keywords(session, sem, token_mgr, location_name,
+                                          months_back=keywords_collector.MONTHS_BACK)
+    )
+
+    daily_records = daily_impressions.process_metrics_data_daily(series) if series else []
+    row_count = 0
+
+    if daily_records:
+        loc_info = {
+            'location_name': location_name,
+            'title': location_title,
+            'address': str(location.get('storefrontAddress', {})),
+            'phone': location.get('phoneNumbers', {}).get('primaryPhone', 'N/A'),
+            'website': location.get('websiteUri', 'N/A'),
+            'maps_url': location.get('metadata', {}).get('mapsUrl', 'N/A')
+        }
+
+        for record in daily_records:
+            record.update(loc_info)
+
+        for row in daily_impressions.transform_to_bigquery_rows(daily_records):
+            await queue.put(row)
+            row_count += 1
+
+    for keyword_record in keywords:
+        keyword_record['location_name'] = location_name
+        keyword_record['location_title'] = location_title
+
+    logger.info(f"[{idx}/{total}] {location_title}: {len(daily_records)} days, {len(keywords)} keywords")
+
+    return row_count, keywords
+
+
+async def collect_everything(credentials, locations, start_date, end_date, client, staging_ref):
+    """Fan out over all locations once, feeding both output tables"""
+    sem = asyncio.Semaphore(daily_impressions.MAX_CONCURRENT_FETCHES)
+    connector = aiohttp.TCPConnector(limit=256, limit_per_host=64)
+    queue = asyncio.Queue()
+    token_mgr = daily_impressions.TokenManager(credentials)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        consumer = asyncio.create_task(
+            daily_impressions.stage_rows_from_queue(queue, client, staging_ref))
+
+        tasks = [
+            collect_location(session, sem, queue, token_mgr, idx, len(locations),
+                             location, start_date, end_date)
+            for idx, location in enumerate(locations, 1)
+        ]
+        results = await asyncio.gather(*tasks)
+
+        await queue.put(None)
+        rows_staged = await consumer
+
+    all_keywords_data = []
+    for _, keywords in results:
+        all_keywords_data.extend(keywords)
+
+    return rows_staged, all_keywords_data
+
+
+def main(request=None):
+    """
+    Main function for Cloud Function
+    Replaces separate impressions and keywords invocations with one sweep:
+    a single auth, a single location fetch, and per-location requests to
+    both endpoints in flight together
+    """
+    logger.info("="*70)
+    logger.info("Starting Combined Impressions & Keywords Collection")
+    logger.info("="*70)
+
+    # Set date range - Last 90 days, ending 3 days ago (API delay)
+    end_date = datetime.now() - timedelta(days=3)
+    start_date = end_date - timedelta(days=90)
+
+    logger.info(f"Metrics date range: {start_date.date()} to {end_date.date()}")
+    logger.info(f"Keyword period: Last {keywords_collector.MONTHS_BACK} months")
+
+    try:
+        # Get credentials
+        logger.info("Authenticating...")
+        credentials = daily_impressions.get_credentials()
+
+        # One location sweep serves both collections - the impressions
+        # readMask is a superset of what the keyword rows need
+        logger.info("Fetching locations...")
+        locations = daily_impressions.get_all_locations(credentials)
+        logger.info(f"Found {len(locations)} location(s)")
+
+        if len(locations) == 0:
+            logger.error("No locations found")
+            return {"status": "error", "message": "No locations found"}, 400
+
+        client = bigquery.Client(project=PROJECT_ID)
+        impressions_ref = f"{PROJECT_ID}.{DATASET_ID}.{IMPRESSIONS_TABLE_ID}"
+        staging_ref = f"{impressions_ref}_stg_{uuid.uuid4().hex}"
+
+        logger.info(f"Collecting both datasets for {len(locations)} location(s)...")
+
+        try:
+            rows_staged, all_keywords_data = asyncio.run(
+                collect_everything(credentials, locations, start_date, end_date, client, staging_ref)
+            )
+
+            if rows_staged:
+                logger.info(f"Merging {rows_staged} staged rows into {impressions_ref}")
+                daily_impressions.merge_staging_into_target(client, impressions_ref, staging_ref)
+            else:
+                logger.warning("No impression rows staged - nothing to merge")
+        finally:
+            client.delete_table(staging_ref, not_found_ok=True)
+
+        # Keyword rows go through the keywords collector's write path
+        keyword_rows = keywords_collector.transform_to_bigquery_rows(all_keywords_data)
+
+        if keyword_rows:
+            logger.info(f"Writing {len(keyword_rows)} keyword rows to BigQuery...")
+            keywords_collector.write_to_bigquery(keyword_rows)
+        else:
+            logger.warning("No valid keywords to write - locations may not have enough traffic")
+
+        logger.info("="*70)
+        logger.info("✅ Combined collection complete!")
+        logger.info(f"Impression records written: {rows_staged}")
+        logger.info(f"Keywords written: {len(keyword_rows)}")
+        logger.info("="*70)
+
+        return {
+            "status": "success",
+            "records_written": rows_staged,
+            "keywords_written": len(keyword_rows),
+            "locations_processed": len(locations),
+            "date_range": {
+                "start": start_date.date().isoformat(),
+                "end": end_date.date().isoformat()
+            }
+        }, 200
+
+    except Exception as e:
+        logger.error(f"Fatal error: {e}", exc_info=True)
+        return {"status": "error", "message": str(e)}, 500
+
+
+# For local testing
+if __name__ == "__main__":
+    result, status_code = main()
+    print(f"\nResult ({status_code}): {result}")
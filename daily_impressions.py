@@ -3,11 +3,26 @@ Google Business Profile - Daily Impressions Data Collection
 Cloud Function to fetch last 90 days of daily metrics and store in BigQuery
 """
 
+import asyncio
+import aiohttp
+import hashlib
+import ijson
+import io
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
 import logging
 import os
-from datetime import datetime, timedelta
-from google.cloud import bigquery
+import sys
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from operator import itemgetter
+from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google.cloud import bigquery, storage
 from google.auth import default
 from google.auth.transport.requests import Request
 
@@ -19,6 +34,83 @@ logger = logging.getLogger(__name__)
 PROJECT_ID = os.environ.get('GCP_PROJECT')
 DATASET_ID = os.environ.get('BQ_DATASET', 'google_business_profile')
 TABLE_ID = os.environ.get('BQ_TABLE_IMPRESSIONS', 'daily_impressions')
+CACHE_BUCKET = os.environ.get('LOCATIONS_CACHE_BUCKET')  # Optional GCS cache for the location list
+LOCATIONS_CACHE_TTL_HOURS = int(os.environ.get('LOCATIONS_CACHE_TTL_HOURS', '6'))
+
+# Daily metrics requested from the Performance API; interned so the
+# per-value dict stores in process_metrics_data_daily hit the
+# interned-string fast path
+METRICS = tuple(sys.intern(m) for m in (
+    'BUSINESS_IMPRESSIONS_DESKTOP_MAPS',
+    'BUSINESS_IMPRESSIONS_DESKTOP_SEARCH',
+    'BUSINESS_IMPRESSIONS_MOBILE_MAPS',
+    'BUSINESS_IMPRESSIONS_MOBILE_SEARCH',
+    'BUSINESS_CONVERSATIONS',
+    'BUSINESS_DIRECTION_REQUESTS',
+    'CALL_CLICKS',
+    'WEBSITE_CLICKS',
+    'BUSINESS_BOOKINGS',
+    'BUSINESS_FOOD_ORDERS'
+))
+
+# Extracts the ten metric values in METRICS order; records from
+# process_metrics_data_daily always carry every metric key
+_GET_METRIC_VALUES = itemgetter(*METRICS)
+
+# Static part of the fetchMultiDailyMetricsTimeSeries query string; only
+# the six date components change per call
+_STATIC_METRICS_QS = urlencode([('dailyMetrics', m) for m in METRICS], doseq=True)
+
+# Concurrency settings for per-location metric fetches
+MAX_CONCURRENT_FETCHES = 32
+MAX_FETCH_RETRIES = 4
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Rows are staged to BigQuery in load jobs of this size while fetches continue
+LOAD_BATCH_ROWS = 10000
+
+# Output schema of transform_to_bigquery_rows. Staged batches are written
+# as Parquet so BigQuery ingests typed columnar data instead of re-parsing
+# JSON rows server-side
+ARROW_SCHEMA = pa.schema([
+    ('date', pa.string()),
+    ('day_of_week', pa.string()),
+    ('week_number', pa.int64()),
+    ('month', pa.int64()),
+    ('month_name', pa.string()),
+    ('year', pa.int64()),
+    ('location_name', pa.string()),
+    ('title', pa.string()),
+    ('phone', pa.string()),
+    ('website', pa.string()),
+    ('address', pa.string()),
+    ('maps_url', pa.string()),
+    ('impressions_desktop_maps', pa.int64()),
+    ('impressions_desktop_search', pa.int64()),
+    ('impressions_mobile_maps', pa.int64()),
+    ('impressions_mobile_search', pa.int64()),
+    ('conversations', pa.int64()),
+    ('direction_requests', pa.int64()),
+    ('call_clicks', pa.int64()),
+    ('website_clicks', pa.int64()),
+    ('bookings', pa.int64()),
+    ('food_orders', pa.int64()),
+    ('total_impressions', pa.int64()),
+    ('total_actions', pa.int64()),
+    ('data_fetched_at', pa.string()),
+])
+
+# Column names in schema order, used to build the MERGE
+ROW_COLUMNS = tuple(ARROW_SCHEMA.names)
+
+# Shared HTTP session - reuses TCP+TLS connections and retries transient errors
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=5, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504])
+))
 
 
 def get_credentials():
@@ -26,140 +118,353 @@ def get_credentials():
     credentials, project = default(scopes=[
         'https://www.googleapis.com/auth/business.manage'
     ])
-    
+
     # Refresh token if needed
     if not credentials.valid:
         credentials.refresh(Request())
-    
+
     return credentials
 
 
+class TokenManager:
+    """Shares one refreshed OAuth token across concurrent fetch coroutines
+
+    Refreshing goes through an asyncio.Lock so a run that spans token
+    expiry triggers exactly one refresh instead of a stampede, and tokens
+    nearing expiry are renewed before they start producing 401s.
+    """
+
+    REFRESH_MARGIN = timedelta(seconds=300)
+
+    def __init__(self, credentials):
+        self._credentials = credentials
+        self._lock = asyncio.Lock()
+
+    def _needs_refresh(self):
+        creds = self._credentials
+        return (not creds.valid or
+                (creds.expiry and creds.expiry - datetime.utcnow() < self.REFRESH_MARGIN))
+
+    async def _refresh(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._credentials.refresh, Request())
+
+    async def force_refresh(self):
+        """Refresh unconditionally, e.g. after a 401"""
+        async with self._lock:
+            await self._refresh()
+
+    async def authed_headers(self):
+        """Request headers with a token fresh for at least REFRESH_MARGIN"""
+        if self._needs_refresh():
+            async with self._lock:
+                if self._needs_refresh():
+                    await self._refresh()
+
+        return {
+            'Authorization': f'Bearer {self._credentials.token}',
+            'Content-Type': 'application/json'
+        }
+
+
+def _locations_cache_name(read_mask):
+    """Cache object name for a given readMask, so compatible callers share it"""
+    return f"locations_{hashlib.md5(read_mask.encode()).hexdigest()[:12]}.json"
+
+
+def _load_cached_locations(read_mask):
+    """Return the cached location list if it is fresh enough, else None"""
+    if not CACHE_BUCKET:
+        return None
+
+    try:
+        blob = storage.Client(project=PROJECT_ID).bucket(CACHE_BUCKET).get_blob(
+            _locations_cache_name(read_mask))
+
+        if blob is None:
+            return None
+
+        age = datetime.now(timezone.utc) - blob.updated
+        if age > timedelta(hours=LOCATIONS_CACHE_TTL_HOURS):
+            return None
+
+        logger.info(f"Using cached location list ({age.total_seconds() / 60:.0f} min old)")
+        return orjson.loads(blob.download_as_bytes())
+
+    except Exception as e:
+        logger.warning(f"Location cache read failed: {e}")
+        return None
+
+
+def _store_cached_locations(read_mask, locations):
+    """Write the fetched location list to the GCS cache"""
+    if not CACHE_BUCKET:
+        return
+
+    try:
+        blob = storage.Client(project=PROJECT_ID).bucket(CACHE_BUCKET).blob(
+            _locations_cache_name(read_mask))
+        blob.upload_from_string(orjson.dumps(locations), content_type='application/json')
+    except Exception as e:
+        logger.warning(f"Location cache write failed: {e}")
+
+
 def get_all_locations(credentials):
-    """Get all locations using accounts/- wildcard"""
+    """Get all locations using accounts/- wildcard, GCS-cached across runs"""
     headers = {
         'Authorization': f'Bearer {credentials.token}',
         'Content-Type': 'application/json'
     }
-    
+
     read_mask = 'name,title,storefrontAddress,phoneNumbers,websiteUri,regularHours,metadata,profile'
     url = 'https://mybusinessbusinessinformation.googleapis.com/v1/accounts/-/locations'
     params = {'readMask': read_mask, 'pageSize': 100}
-    
+
+    cached = _load_cached_locations(read_mask)
+    if cached is not None:
+        return cached
+
     all_locations = []
-    
+
     while True:
-        try:
-            response = requests.get(url, headers=headers, params=params, timeout=30)
-            response.raise_for_status()
-            
-            data = response.json()
-            
-            if 'locations' in data:
-                all_locations.extend(data['locations'])
-                logger.info(f"Fetched {len(data['locations'])} locations")
-            
-            if 'nextPageToken' in data:
-                params['pageToken'] = data['nextPageToken']
-            else:
-                break
-                
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching locations: {e}")
+        response = SESSION.get(url, headers=headers, params=params, timeout=30)
+        response.raise_for_status()
+
+        data = orjson.loads(response.content)
+
+        if 'locations' in data:
+            all_locations.extend(data['locations'])
+            logger.info(f"Fetched {len(data['locations'])} locations")
+
+        if 'nextPageToken' in data:
+            params['pageToken'] = data['nextPageToken']
+        else:
             break
-    
+
+    _store_cached_locations(read_mask, all_locations)
+
     return all_locations
 
 
-def get_performance_metrics(credentials, location_name, start_date, end_date):
-    """Get performance metrics for a date range"""
-    headers = {
-        'Authorization': f'Bearer {credentials.token}',
-        'Content-Type': 'application/json'
-    }
-    
+async def fetch_metrics(session, sem, token_mgr, location_name, start_date, end_date):
+    """Fetch performance metrics for a date range (async, with backoff on 429/5xx)"""
     location_id = location_name.split('/')[-1]
-    url = f'https://businessprofileperformance.googleapis.com/v1/locations/{location_id}:fetchMultiDailyMetricsTimeSeries'
-    
-    metrics = [
-        'BUSINESS_IMPRESSIONS_DESKTOP_MAPS',
-        'BUSINESS_IMPRESSIONS_DESKTOP_SEARCH',
-        'BUSINESS_IMPRESSIONS_MOBILE_MAPS',
-        'BUSINESS_IMPRESSIONS_MOBILE_SEARCH',
-        'BUSINESS_CONVERSATIONS',
-        'BUSINESS_DIRECTION_REQUESTS',
-        'CALL_CLICKS',
-        'WEBSITE_CLICKS',
-        'BUSINESS_BOOKINGS',
-        'BUSINESS_FOOD_ORDERS'
-    ]
-    
-    params = {
-        'dailyMetrics': metrics,
-        'dailyRange.start_date.year': start_date.year,
-        'dailyRange.start_date.month': start_date.month,
-        'dailyRange.start_date.day': start_date.day,
-        'dailyRange.end_date.year': end_date.year,
-        'dailyRange.end_date.month': end_date.month,
-        'dailyRange.end_date.day': end_date.day
+
+    date_qs = urlencode([
+        ('dailyRange.start_date.year', start_date.year),
+        ('dailyRange.start_date.month', start_date.month),
+        ('dailyRange.start_date.day', start_date.day),
+        ('dailyRange.end_date.year', end_date.year),
+        ('dailyRange.end_date.month', end_date.month),
+        ('dailyRange.end_date.day', end_date.day)
+    ])
+
+    url = (f'https://businessprofileperformance.googleapis.com/v1/locations/'
+           f'{location_id}:fetchMultiDailyMetricsTimeSeries?{_STATIC_METRICS_QS}&{date_qs}')
+
+    async with sem:
+        for attempt in range(MAX_FETCH_RETRIES + 1):
+            headers = await token_mgr.authed_headers()
+
+            try:
+                async with session.get(url, headers=headers,
+                                       timeout=aiohttp.ClientTimeout(total=30)) as response:
+                    if response.status == 401 and attempt < MAX_FETCH_RETRIES:
+                        logger.warning(f"Got 401 for {location_name}, refreshing token")
+                        await token_mgr.force_refresh()
+                        continue
+
+                    if response.status in RETRYABLE_STATUSES and attempt < MAX_FETCH_RETRIES:
+                        logger.warning(f"Got {response.status} for {location_name}, retrying in {2 ** attempt}s")
+                        await asyncio.sleep(2 ** attempt)
+                        continue
+
+                    response.raise_for_status()
+                    # Stream-parse the per-metric series out of the response
+                    # instead of materializing the whole tree at once
+                    return [series async for series in
+                            ijson.items(response.content, 'multiDailyMetricTimeSeries.item')]
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"Error fetching metrics for {location_name}: {e}")
+                return None
+
+    return None
+
+
+async def collect_location(session, sem, queue, token_mgr, idx, total, location, start_date, end_date):
+    """Fetch, process, and enqueue BigQuery rows for one location"""
+    location_name = location['name']
+    location_title = location.get('title', 'N/A')
+
+    series = await fetch_metrics(session, sem, token_mgr, location_name, start_date, end_date)
+    daily_records = process_metrics_data_daily(series) if series else []
+
+    if not daily_records:
+        logger.warning(f"[{idx}/{total}] ⚠️ No metrics data for {location_title}")
+        return 0
+
+    logger.info(f"[{idx}/{total}] ✅ {location_title}: {len(daily_records)} days of data")
+
+    # Add location info to each record - formatted once per location, not
+    # once per daily record
+    loc_info = {
+        'location_name': location_name,
+        'title': location_title,
+        'address': str(location.get('storefrontAddress', {})),
+        'phone': location.get('phoneNumbers', {}).get('primaryPhone', 'N/A'),
+        'website': location.get('websiteUri', 'N/A'),
+        'maps_url': location.get('metadata', {}).get('mapsUrl', 'N/A')
     }
-    
-    try:
-        response = requests.get(url, headers=headers, params=params, timeout=30)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error fetching metrics for {location_name}: {e}")
-        return None
 
+    for record in daily_records:
+        record.update(loc_info)
+
+    row_count = 0
+    for row in transform_to_bigquery_rows(daily_records):
+        await queue.put(row)
+        row_count += 1
+
+    return row_count
+
+
+async def stage_rows_from_queue(queue, client, staging_ref):
+    """Drain rows from the queue and stage them in batched load jobs
+
+    Runs alongside the fetch coroutines so BigQuery job latency is hidden
+    behind the remaining API calls. A None on the queue signals end of input.
+    """
+    loop = asyncio.get_running_loop()
+    staged = 0
+    batch = []
+
+    while True:
+        row = await queue.get()
+
+        if row is not None:
+            batch.append(row)
+
+        if row is None or len(batch) >= LOAD_BATCH_ROWS:
+            if batch:
+                await loop.run_in_executor(None, load_rows_to_staging, client, staging_ref, batch)
+                staged += len(batch)
+                batch = []
+            if row is None:
+                break
+
+    return staged
+
+
+async def collect_and_stage(credentials, locations, start_date, end_date, client, staging_ref):
+    """Fetch all locations concurrently, staging rows while fetches continue"""
+    sem = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+    connector = aiohttp.TCPConnector(limit=256, limit_per_host=64)
+    queue = asyncio.Queue()
+    token_mgr = TokenManager(credentials)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        consumer = asyncio.create_task(stage_rows_from_queue(queue, client, staging_ref))
+
+        tasks = [
+            collect_location(session, sem, queue, token_mgr, idx, len(locations),
+                             location, start_date, end_date)
+            for idx, location in enumerate(locations, 1)
+        ]
+        await asyncio.gather(*tasks)
 
-def process_metrics_data_daily(metrics_response):
-    """Process metrics response to return DAILY data"""
-    if not metrics_response:
+        await queue.put(None)
+        return await consumer
+
+
+def process_metrics_data_daily(metric_series):
+    """Process fetched metric time series items to return DAILY data"""
+    if not metric_series:
         return []
-    
-    daily_data = {}
-    
-    for multi_series in metrics_response.get('multiDailyMetricTimeSeries', []):
+
+    # Each date starts with every known metric zeroed, so downstream code
+    # can index metrics directly instead of defaulting per lookup
+    daily_data = defaultdict(lambda: dict.fromkeys(METRICS, 0))
+
+    for multi_series in metric_series:
         for daily_series in multi_series.get('dailyMetricTimeSeries', []):
-            metric = daily_series.get('dailyMetric', 'UNKNOWN')
+            metric = sys.intern(daily_series.get('dailyMetric', 'UNKNOWN'))
             time_series = daily_series.get('timeSeries', {})
-            dated_values = time_series.get('datedValues', [])
-            
-            for dated_value in dated_values:
+
+            for dated_value in time_series.get('datedValues', []):
                 date_obj = dated_value.get('date', {})
                 date_str = f"{date_obj.get('year')}-{date_obj.get('month'):02d}-{date_obj.get('day'):02d}"
-                
-                if date_str not in daily_data:
-                    daily_data[date_str] = {}
-                
-                value = int(dated_value.get('value', 0))
-                daily_data[date_str][metric] = value
-    
-    daily_records = []
-    for date_str, metrics in daily_data.items():
-        record = {'date': date_str}
-        record.update(metrics)
-        daily_records.append(record)
-    
-    return daily_records
+                daily_data[date_str][metric] = int(dated_value.get('value', 0))
+
+    return [{'date': date_str, **metrics} for date_str, metrics in daily_data.items()]
+
+
+def _date_fields(date_obj):
+    """Derive the calendar fields stored alongside each daily row"""
+    return (
+        date_obj.strftime('%A'),
+        date_obj.isocalendar()[1],
+        date_obj.month,
+        date_obj.strftime('%B'),
+        date_obj.year
+    )
+
+
+def _calendar_table(date_strs):
+    """Calendar fields for every day spanning the given date strings
+
+    Parses only the two boundary dates and walks the span with timedelta,
+    so a 90-day run costs two strptime calls regardless of row count.
+    """
+    day = datetime.strptime(min(date_strs), '%Y-%m-%d')
+    end = datetime.strptime(max(date_strs), '%Y-%m-%d')
+
+    table = {}
+    while day <= end:
+        table[day.strftime('%Y-%m-%d')] = _date_fields(day)
+        day += timedelta(days=1)
+
+    return table
 
 
 def transform_to_bigquery_rows(all_daily_data):
-    """Transform raw data to BigQuery-ready rows"""
-    rows = []
-    
+    """Yield BigQuery-ready rows for the given daily records
+
+    A generator, so callers can stream rows straight into batched load
+    jobs without ever holding the full row list in memory.
+
+    (location, date) pairs whose metrics are all zero are skipped, the
+    same way keywords_collector drops zero-impression keywords - on
+    low-traffic locations that is most of the date range. Downstream
+    queries should treat a missing date as zero activity.
+    """
+    fetched_at = datetime.utcnow().isoformat()
+
+    # Every location shares the same ~90 dates, so derive the calendar
+    # fields once per day of the span instead of strptime/strftime per row
+    date_cache = _calendar_table({record['date'] for record in all_daily_data})
+
     for record in all_daily_data:
-        # Parse date
-        date_obj = datetime.strptime(record['date'], '%Y-%m-%d')
-        
+        day_of_week, week_number, month, month_name, year = date_cache[record['date']]
+
+        metric_values = _GET_METRIC_VALUES(record)
+
+        # Skip days with no recorded activity at all
+        if not any(metric_values):
+            continue
+
+        (impressions_desktop_maps, impressions_desktop_search,
+         impressions_mobile_maps, impressions_mobile_search,
+         conversations, direction_requests, call_clicks, website_clicks,
+         bookings, food_orders) = metric_values
+
         row = {
             'date': record['date'],
-            'day_of_week': date_obj.strftime('%A'),
-            'week_number': date_obj.isocalendar()[1],
-            'month': date_obj.month,
-            'month_name': date_obj.strftime('%B'),
-            'year': date_obj.year,
-            
+            'day_of_week': day_of_week,
+            'week_number': week_number,
+            'month': month,
+            'month_name': month_name,
+            'year': year,
+
             # Location info
             'location_name': record['location_name'],
             'title': record['title'],
@@ -167,85 +472,69 @@ def transform_to_bigquery_rows(all_daily_data):
             'website': record.get('website', ''),
             'address': record.get('address', ''),
             'maps_url': record.get('maps_url', ''),
-            
+
             # Impressions
-            'impressions_desktop_maps': record.get('BUSINESS_IMPRESSIONS_DESKTOP_MAPS', 0),
-            'impressions_desktop_search': record.get('BUSINESS_IMPRESSIONS_DESKTOP_SEARCH', 0),
-            'impressions_mobile_maps': record.get('BUSINESS_IMPRESSIONS_MOBILE_MAPS', 0),
-            'impressions_mobile_search': record.get('BUSINESS_IMPRESSIONS_MOBILE_SEARCH', 0),
-            
+            'impressions_desktop_maps': impressions_desktop_maps,
+            'impressions_desktop_search': impressions_desktop_search,
+            'impressions_mobile_maps': impressions_mobile_maps,
+            'impressions_mobile_search': impressions_mobile_search,
+
             # Actions
-            'conversations': record.get('BUSINESS_CONVERSATIONS', 0),
-            'direction_requests': record.get('BUSINESS_DIRECTION_REQUESTS', 0),
-            'call_clicks': record.get('CALL_CLICKS', 0),
-            'website_clicks': record.get('WEBSITE_CLICKS', 0),
-            'bookings': record.get('BUSINESS_BOOKINGS', 0),
-            'food_orders': record.get('BUSINESS_FOOD_ORDERS', 0),
-            
+            'conversations': conversations,
+            'direction_requests': direction_requests,
+            'call_clicks': call_clicks,
+            'website_clicks': website_clicks,
+            'bookings': bookings,
+            'food_orders': food_orders,
+
             # Calculated fields
             'total_impressions': (
-                record.get('BUSINESS_IMPRESSIONS_DESKTOP_MAPS', 0) +
-                record.get('BUSINESS_IMPRESSIONS_DESKTOP_SEARCH', 0) +
-                record.get('BUSINESS_IMPRESSIONS_MOBILE_MAPS', 0) +
-                record.get('BUSINESS_IMPRESSIONS_MOBILE_SEARCH', 0)
+                impressions_desktop_maps + impressions_desktop_search +
+                impressions_mobile_maps + impressions_mobile_search
             ),
             'total_actions': (
-                record.get('WEBSITE_CLICKS', 0) +
-                record.get('CALL_CLICKS', 0) +
-                record.get('BUSINESS_DIRECTION_REQUESTS', 0) +
-                record.get('BUSINESS_CONVERSATIONS', 0)
+                website_clicks + call_clicks +
+                direction_requests + conversations
             ),
-            
+
             # Metadata
-            'data_fetched_at': datetime.utcnow().isoformat()
+            'data_fetched_at': fetched_at
         }
-        
-        rows.append(row)
-    
-    return rows
 
+        yield row
+
+
+def load_rows_to_staging(client, staging_ref, rows):
+    """Load one batch of rows into the staging table (blocking; run in executor)"""
+    table = pa.Table.from_pylist(rows, schema=ARROW_SCHEMA)
+
+    buf = io.BytesIO()
+    pq.write_table(table, buf, compression='snappy')
 
-def write_to_bigquery(rows):
-    """Write rows to BigQuery with upsert logic"""
-    if not rows:
-        logger.warning("No rows to write to BigQuery")
-        return
-    
-    client = bigquery.Client(project=PROJECT_ID)
-    table_ref = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
-    
-    # Configure write disposition to replace data for the date range
     job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
         write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
-        schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION],
     )
-    
-    try:
-        # First, delete existing records for this date range
-        dates = set(row['date'] for row in rows)
-        date_list = "', '".join(dates)
-        
-        delete_query = f"""
-        DELETE FROM `{table_ref}`
-        WHERE date IN ('{date_list}')
-        """
-        
-        logger.info(f"Deleting existing records for {len(dates)} dates")
-        client.query(delete_query).result()
-        
-        # Insert new records
-        logger.info(f"Inserting {len(rows)} new records")
-        errors = client.insert_rows_json(table_ref, rows)
-        
-        if errors:
-            logger.error(f"BigQuery insert errors: {errors}")
-            raise Exception(f"Failed to insert rows: {errors}")
-        
-        logger.info(f"Successfully wrote {len(rows)} rows to BigQuery")
-        
-    except Exception as e:
-        logger.error(f"BigQuery write error: {e}")
-        raise
+
+    logger.info(f"Staging {len(rows)} rows")
+    client.load_table_from_file(buf, staging_ref, rewind=True, job_config=job_config).result()
+
+
+def merge_staging_into_target(client, table_ref, staging_ref):
+    """MERGE the staged rows into the target keyed on (date, location_name)"""
+    update_columns = [c for c in ROW_COLUMNS if c not in ('date', 'location_name')]
+
+    merge_query = f"""
+    MERGE `{table_ref}` T
+    USING `{staging_ref}` S
+    ON T.date = S.date AND T.location_name = S.location_name
+    WHEN MATCHED THEN UPDATE SET
+        {', '.join(f'T.{c} = S.{c}' for c in update_columns)}
+    WHEN NOT MATCHED THEN INSERT ({', '.join(ROW_COLUMNS)})
+        VALUES ({', '.join(f'S.{c}' for c in ROW_COLUMNS)})
+    """
+
+    client.query(merge_query).result()
 
 
 def main(request=None):
@@ -278,50 +567,35 @@ def main(request=None):
             logger.error("No locations found")
             return {"status": "error", "message": "No locations found"}, 400
         
-        # Collect data for all locations
-        all_daily_data = []
-        
-        for idx, location in enumerate(locations, 1):
-            location_name = location['name']
-            location_title = location.get('title', 'N/A')
-            
-            logger.info(f"[{idx}/{len(locations)}] Processing: {location_title}")
-            
-            # Get metrics
-            metrics = get_performance_metrics(credentials, location_name, start_date, end_date)
-            daily_records = process_metrics_data_daily(metrics) if metrics else []
-            
-            if daily_records:
-                logger.info(f"  ✅ Got {len(daily_records)} days of data")
-                
-                # Add location info to each record
-                for record in daily_records:
-                    record['location_name'] = location_name
-                    record['title'] = location_title
-                    record['address'] = str(location.get('storefrontAddress', {}))
-                    record['phone'] = location.get('phoneNumbers', {}).get('primaryPhone', 'N/A')
-                    record['website'] = location.get('websiteUri', 'N/A')
-                    record['maps_url'] = location.get('metadata', {}).get('mapsUrl', 'N/A')
-                    
-                    all_daily_data.append(record)
+        # Fetch all locations concurrently, staging rows to BigQuery as
+        # batches fill, then merge the staging table into the target
+        client = bigquery.Client(project=PROJECT_ID)
+        table_ref = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
+        staging_ref = f"{table_ref}_stg_{uuid.uuid4().hex}"
+
+        logger.info(f"Fetching metrics for {len(locations)} location(s) concurrently...")
+
+        try:
+            rows_staged = asyncio.run(
+                collect_and_stage(credentials, locations, start_date, end_date, client, staging_ref)
+            )
+
+            if rows_staged:
+                logger.info(f"Merging {rows_staged} staged rows into {table_ref}")
+                merge_staging_into_target(client, table_ref, staging_ref)
             else:
-                logger.warning(f"  ⚠️ No metrics data for {location_title}")
-        
-        # Transform and write to BigQuery
-        logger.info(f"Transforming {len(all_daily_data)} records...")
-        rows = transform_to_bigquery_rows(all_daily_data)
-        
-        logger.info("Writing to BigQuery...")
-        write_to_bigquery(rows)
-        
+                logger.warning("No rows staged - nothing to merge")
+        finally:
+            client.delete_table(staging_ref, not_found_ok=True)
+
         logger.info("="*70)
         logger.info("✅ Data collection complete!")
-        logger.info(f"Total records written: {len(rows)}")
+        logger.info(f"Total records written: {rows_staged}")
         logger.info("="*70)
-        
+
         return {
             "status": "success",
-            "records_written": len(rows),
+            "records_written": rows_staged,
             "locations_processed": len(locations),
             "date_range": {
                 "start": start_date.date().isoformat(),
@@ -3,11 +3,19 @@ Google Business Profile - Search Keywords Collector
 Cloud Function to fetch monthly search keywords and store in BigQuery
 """
 
+import asyncio
+import aiohttp
+import hashlib
+import ijson
+import io
+import orjson
 import requests
 import logging
 import os
-from datetime import datetime, timedelta
-from google.cloud import bigquery
+from datetime import datetime, timedelta, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google.cloud import bigquery, storage
 from google.auth import default
 from google.auth.transport.requests import Request
 
@@ -20,6 +28,22 @@ PROJECT_ID = os.environ.get('GCP_PROJECT')
 DATASET_ID = os.environ.get('BQ_DATASET', 'google_business_profile')
 TABLE_ID = os.environ.get('BQ_TABLE_KEYWORDS', 'search_keywords')
 MONTHS_BACK = int(os.environ.get('MONTHS_BACK', '3'))  # Default 3 months
+CACHE_BUCKET = os.environ.get('LOCATIONS_CACHE_BUCKET')  # Optional GCS cache for the location list
+LOCATIONS_CACHE_TTL_HOURS = int(os.environ.get('LOCATIONS_CACHE_TTL_HOURS', '6'))
+
+# Concurrency settings for per-location keyword fetches
+MAX_CONCURRENT_FETCHES = 32
+MAX_FETCH_RETRIES = 4
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Shared HTTP session - reuses TCP+TLS connections and retries transient errors
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=5, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504])
+))
 
 
 def get_credentials():
@@ -27,95 +51,233 @@ def get_credentials():
     credentials, project = default(scopes=[
         'https://www.googleapis.com/auth/business.manage'
     ])
-    
+
     if not credentials.valid:
         credentials.refresh(Request())
-    
+
     return credentials
 
 
+class TokenManager:
+    """Shares one refreshed OAuth token across concurrent fetch coroutines
+
+    Refreshing goes through an asyncio.Lock so a run that spans token
+    expiry triggers exactly one refresh instead of a stampede, and tokens
+    nearing expiry are renewed before they start producing 401s.
+    """
+
+    REFRESH_MARGIN = timedelta(seconds=300)
+
+    def __init__(self, credentials):
+        self._credentials = credentials
+        self._lock = asyncio.Lock()
+
+    def _needs_refresh(self):
+        creds = self._credentials
+        return (not creds.valid or
+                (creds.expiry and creds.expiry - datetime.utcnow() < self.REFRESH_MARGIN))
+
+    async def _refresh(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._credentials.refresh, Request())
+
+    async def force_refresh(self):
+        """Refresh unconditionally, e.g. after a 401"""
+        async with self._lock:
+            await self._refresh()
+
+    async def authed_headers(self):
+        """Request headers with a token fresh for at least REFRESH_MARGIN"""
+        if self._needs_refresh():
+            async with self._lock:
+                if self._needs_refresh():
+                    await self._refresh()
+
+        return {
+            'Authorization': f'Bearer {self._credentials.token}',
+            'Content-Type': 'application/json'
+        }
+
+
+def _locations_cache_name(read_mask):
+    """Cache object name for a given readMask, so compatible callers share it"""
+    return f"locations_{hashlib.md5(read_mask.encode()).hexdigest()[:12]}.json"
+
+
+def _load_cached_locations(read_mask):
+    """Return the cached location list if it is fresh enough, else None"""
+    if not CACHE_BUCKET:
+        return None
+
+    try:
+        blob = storage.Client(project=PROJECT_ID).bucket(CACHE_BUCKET).get_blob(
+            _locations_cache_name(read_mask))
+
+        if blob is None:
+            return None
+
+        age = datetime.now(timezone.utc) - blob.updated
+        if age > timedelta(hours=LOCATIONS_CACHE_TTL_HOURS):
+            return None
+
+        logger.info(f"Using cached location list ({age.total_seconds() / 60:.0f} min old)")
+        return orjson.loads(blob.download_as_bytes())
+
+    except Exception as e:
+        logger.warning(f"Location cache read failed: {e}")
+        return None
+
+
+def _store_cached_locations(read_mask, locations):
+    """Write the fetched location list to the GCS cache"""
+    if not CACHE_BUCKET:
+        return
+
+    try:
+        blob = storage.Client(project=PROJECT_ID).bucket(CACHE_BUCKET).blob(
+            _locations_cache_name(read_mask))
+        blob.upload_from_string(orjson.dumps(locations), content_type='application/json')
+    except Exception as e:
+        logger.warning(f"Location cache write failed: {e}")
+
+
 def get_all_locations(credentials):
-    """Get all locations using accounts/- wildcard"""
+    """Get all locations using accounts/- wildcard, GCS-cached across runs"""
     headers = {
         'Authorization': f'Bearer {credentials.token}',
         'Content-Type': 'application/json'
     }
-    
+
     read_mask = 'name,title,storefrontAddress,metadata'
     url = 'https://mybusinessbusinessinformation.googleapis.com/v1/accounts/-/locations'
     params = {'readMask': read_mask, 'pageSize': 100}
-    
+
+    cached = _load_cached_locations(read_mask)
+    if cached is not None:
+        return cached
+
     all_locations = []
-    
+
     while True:
-        try:
-            response = requests.get(url, headers=headers, params=params, timeout=30)
-            response.raise_for_status()
-            
-            data = response.json()
-            
-            if 'locations' in data:
-                all_locations.extend(data['locations'])
-                logger.info(f"Fetched {len(data['locations'])} locations")
-            
-            if 'nextPageToken' in data:
-                params['pageToken'] = data['nextPageToken']
-            else:
-                break
-                
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching locations: {e}")
+        response = SESSION.get(url, headers=headers, params=params, timeout=30)
+        response.raise_for_status()
+
+        data = orjson.loads(response.content)
+
+        if 'locations' in data:
+            all_locations.extend(data['locations'])
+            logger.info(f"Fetched {len(data['locations'])} locations")
+
+        if 'nextPageToken' in data:
+            params['pageToken'] = data['nextPageToken']
+        else:
             break
-    
+
+    _store_cached_locations(read_mask, all_locations)
+
     return all_locations
 
 
-def get_search_keywords(credentials, location_name, months_back=3):
-    """Get search keywords for a location"""
-    headers = {
-        'Authorization': f'Bearer {credentials.token}',
-        'Content-Type': 'application/json'
-    }
-    
+async def _parse_keywords_page(body):
+    """Stream-parse one keywords page, yielding records and the page token
+
+    Keeps memory flat relative to page size: each keyword record is built
+    from the byte stream as it arrives instead of materializing the whole
+    response tree first.
+    """
+    keywords = []
+    page_token = None
+    builder = None
+
+    async for prefix, event, value in ijson.parse(body):
+        if builder is None and prefix == 'searchKeywordsCounts.item' and event == 'start_map':
+            builder = ijson.ObjectBuilder()
+
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == 'searchKeywordsCounts.item' and event == 'end_map':
+                keywords.append(builder.value)
+                builder = None
+        elif prefix == 'nextPageToken':
+            page_token = value
+
+    return keywords, page_token
+
+
+async def fetch_keywords(session, sem, token_mgr, location_name, months_back=3):
+    """Fetch search keywords for a location (async, with backoff on 429/5xx)"""
     location_id = location_name.split('/')[-1]
     end_date = datetime.now()
     start_date = end_date - timedelta(days=months_back*30)
-    
+
     url = f'https://businessprofileperformance.googleapis.com/v1/locations/{location_id}/searchkeywords/impressions/monthly'
-    
+
     params = {
-        'monthlyRange.start_month.year': start_date.year,
-        'monthlyRange.start_month.month': start_date.month,
-        'monthlyRange.end_month.year': end_date.year,
-        'monthlyRange.end_month.month': end_date.month,
-        'pageSize': 100
+        'monthlyRange.start_month.year': str(start_date.year),
+        'monthlyRange.start_month.month': str(start_date.month),
+        'monthlyRange.end_month.year': str(end_date.year),
+        'monthlyRange.end_month.month': str(end_date.month),
+        'pageSize': '100'
     }
-    
+
     all_keywords = []
-    
-    while True:
-        try:
-            response = requests.get(url, headers=headers, params=params, timeout=30)
-            response.raise_for_status()
-            
-            data = response.json()
-            
-            if 'searchKeywordsCounts' in data:
-                all_keywords.extend(data['searchKeywordsCounts'])
-                logger.info(f"Fetched {len(data['searchKeywordsCounts'])} keywords")
-            
-            if 'nextPageToken' in data:
-                params['pageToken'] = data['nextPageToken']
+
+    async with sem:
+        while True:
+            page = None
+
+            for attempt in range(MAX_FETCH_RETRIES + 1):
+                headers = await token_mgr.authed_headers()
+
+                try:
+                    async with session.get(url, headers=headers, params=params,
+                                           timeout=aiohttp.ClientTimeout(total=30)) as response:
+                        if response.status == 401 and attempt < MAX_FETCH_RETRIES:
+                            logger.warning(f"Got 401 for {location_name}, refreshing token")
+                            await token_mgr.force_refresh()
+                            continue
+
+                        if response.status in RETRYABLE_STATUSES and attempt < MAX_FETCH_RETRIES:
+                            logger.warning(f"Got {response.status} for {location_name}, retrying in {2 ** attempt}s")
+                            await asyncio.sleep(2 ** attempt)
+                            continue
+
+                        response.raise_for_status()
+                        page = await _parse_keywords_page(response.content)
+                        break
+
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logger.error(f"Error fetching keywords for {location_name}: {e}")
+                    return all_keywords
+
+            if page is None:
+                return all_keywords
+
+            page_keywords, page_token = page
+            all_keywords.extend(page_keywords)
+
+            if page_token:
+                params['pageToken'] = page_token
             else:
                 break
-                
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching keywords for {location_name}: {e}")
-            break
-    
+
     return all_keywords
 
 
+async def fetch_all_keywords(credentials, locations, months_back=3):
+    """Fetch keywords for all locations concurrently"""
+    sem = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+    connector = aiohttp.TCPConnector(limit=256, limit_per_host=64)
+    token_mgr = TokenManager(credentials)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = [
+            fetch_keywords(session, sem, token_mgr, location['name'], months_back=months_back)
+            for location in locations
+        ]
+        return await asyncio.gather(*tasks)
+
+
 def extract_keyword_value(search_keyword):
     """Extract keyword string from nested structure"""
     if isinstance(search_keyword, dict):
@@ -136,18 +298,20 @@ def extract_impressions(insights_value):
 def transform_to_bigquery_rows(all_keywords_data):
     """Transform raw keyword data to BigQuery-ready rows"""
     rows = []
-    current_timestamp = datetime.utcnow().isoformat()
-    
+    now = datetime.utcnow()
+    current_timestamp = now.isoformat()
+    collection_date = now.date().isoformat()
+
     for record in all_keywords_data:
         keyword = extract_keyword_value(record.get('searchKeyword', {}))
         impressions = extract_impressions(record.get('insightsValue', {}))
-        
+
         # Skip keywords with zero impressions
         if impressions == 0 or keyword == 'UNKNOWN':
             continue
-        
+
         row = {
-            'collection_date': datetime.utcnow().date().isoformat(),
+            'collection_date': collection_date,
             'location_name': record['location_name'],
             'location_title': record['location_title'],
             'keyword': keyword,
@@ -171,25 +335,36 @@ def write_to_bigquery(rows):
     table_ref = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
     
     try:
-        # Delete existing records for today's collection
+        # Delete existing records for today's collection. Parameterized so
+        # the query text is identical across runs (plan-cache friendly) and
+        # no date literal is spliced into the SQL
         collection_date = datetime.utcnow().date().isoformat()
-        
+
         delete_query = f"""
         DELETE FROM `{table_ref}`
-        WHERE collection_date = '{collection_date}'
+        WHERE collection_date = @collection_date
         """
-        
+
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter('collection_date', 'DATE', collection_date)
+        ])
+
         logger.info(f"Deleting existing records for {collection_date}")
-        client.query(delete_query).result()
-        
-        # Insert new records
-        logger.info(f"Inserting {len(rows)} new keyword records")
-        errors = client.insert_rows_json(table_ref, rows)
-        
-        if errors:
-            logger.error(f"BigQuery insert errors: {errors}")
-            raise Exception(f"Failed to insert rows: {errors}")
-        
+        client.query(delete_query, job_config=job_config).result()
+
+        # Insert new records via a load job - batched, quota-friendly path
+        # instead of per-row streaming inserts
+        buf = io.BytesIO(b'\n'.join(orjson.dumps(row) for row in rows))
+
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION],
+        )
+
+        logger.info(f"Loading {len(rows)} new keyword records")
+        client.load_table_from_file(buf, table_ref, rewind=True, job_config=job_config).result()
+
         logger.info(f"Successfully wrote {len(rows)} rows to BigQuery")
         
     except Exception as e:
@@ -223,31 +398,30 @@ def main(request=None):
             logger.error("No locations found")
             return {"status": "error", "message": "No locations found"}, 400
         
+        # Fetch keywords for all locations concurrently
+        logger.info(f"Fetching keywords for {len(locations)} location(s) concurrently...")
+        keyword_responses = asyncio.run(fetch_all_keywords(credentials, locations, months_back=MONTHS_BACK))
+
         # Collect keywords for all locations
         all_keywords_data = []
         locations_with_data = 0
-        
-        for idx, location in enumerate(locations, 1):
+
+        for idx, (location, keywords) in enumerate(zip(locations, keyword_responses), 1):
             location_name = location['name']
             location_title = location.get('title', 'N/A')
-            
-            logger.info(f"[{idx}/{len(locations)}] Processing: {location_title}")
-            
-            # Get keywords
-            keywords = get_search_keywords(credentials, location_name, months_back=MONTHS_BACK)
-            
+
             if keywords:
-                logger.info(f"  ✅ Got {len(keywords)} keywords")
+                logger.info(f"[{idx}/{len(locations)}] ✅ {location_title}: {len(keywords)} keywords")
                 locations_with_data += 1
-                
+
                 # Add location info to each keyword record
                 for keyword_record in keywords:
                     keyword_record['location_name'] = location_name
                     keyword_record['location_title'] = location_title
-                    
+
                 all_keywords_data.extend(keywords)
             else:
-                logger.warning(f"  ⚠️ No keyword data for {location_title}")
+                logger.warning(f"[{idx}/{len(locations)}] ⚠️ No keyword data for {location_title}")
         
         # Transform and write to BigQuery
         logger.info(f"Transforming {len(all_keywords_data)} keyword records...")
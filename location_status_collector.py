@@ -3,10 +3,16 @@ Google Business Profile - Location Status & Ratings Collector
 Collects verification status, publishing status, and ratings data
 """
 
+import orjson
 import requests
 import logging
 import os
-from datetime import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.cloud import bigquery
 from google.auth import default
 from google.auth.transport.requests import Request
@@ -20,18 +26,137 @@ PROJECT_ID = os.environ.get('GCP_PROJECT')
 DATASET_ID = os.environ.get('BQ_DATASET', 'google_business_profile')
 TABLE_ID = os.environ.get('BQ_TABLE_STATUS', 'location_status')
 PLACES_API_KEY = os.environ.get('PLACES_API_KEY')  # Google Places API key
+PLACES_CONCURRENCY = int(os.environ.get('PLACES_CONCURRENCY', '16'))  # Parallel Places lookups
+PLACES_QPS = int(os.environ.get('PLACES_QPS', '10'))  # Steady-state Places request rate
+PLACES_CACHE_TABLE_ID = os.environ.get('BQ_TABLE_PLACES_CACHE', 'places_cache')
+PLACES_CACHE_FRESH_HOURS = 24  # Cached ratings younger than this skip the API entirely
+PLACES_CACHE_STALE_HOURS = 72  # Between fresh and this, serve stale and refresh in background
+PLACES_DENYLIST_TABLE_ID = os.environ.get('BQ_TABLE_PLACES_DENYLIST', 'places_no_rating')
+PLACES_DENYLIST_DAYS = 7  # Skip place_ids that definitively failed within this window
+
+# Shared HTTP session - reuses TCP+TLS connections across the location
+# pagination and the threaded Places lookups, and retries transient errors
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=5, backoff_factor=0.3,
+                      status_forcelist=[429, 500, 502, 503, 504])
+))
+
+
+class TokenBucket:
+    """Thread-safe token bucket capping steady-state request rate at rate/sec
+
+    acquire() blocks until a token is available; tokens accumulate up to
+    one second's worth, so traffic is pre-shaped under the Places quota
+    instead of bursting into 429s and paying the backoff tax.
+    """
+
+    def __init__(self, rate):
+        self._rate = rate
+        self._tokens = float(rate)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(float(self._rate),
+                                   self._tokens + (now - self._last_refill) * self._rate)
+                self._last_refill = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self._rate
+
+            time.sleep(wait)
+
+
+# Shared limiter for all Places API calls across the worker threads
+_PLACES_BUCKET = TokenBucket(PLACES_QPS)
+
+# Explicit schema for location_status load jobs
+STATUS_SCHEMA = [
+    bigquery.SchemaField('check_date', 'DATE'),
+    bigquery.SchemaField('check_timestamp', 'TIMESTAMP'),
+    bigquery.SchemaField('title', 'STRING'),
+    bigquery.SchemaField('location_id', 'STRING'),
+    bigquery.SchemaField('phone', 'STRING'),
+    bigquery.SchemaField('website', 'STRING'),
+    bigquery.SchemaField('address', 'RECORD', fields=[
+        bigquery.SchemaField('locality', 'STRING'),
+        bigquery.SchemaField('region_code', 'STRING'),
+        bigquery.SchemaField('postal_code', 'STRING'),
+        bigquery.SchemaField('address_lines', 'STRING', mode='REPEATED'),
+    ]),
+    bigquery.SchemaField('overall_status', 'STRING'),
+    bigquery.SchemaField('verification_status', 'STRING'),
+    bigquery.SchemaField('publish_status', 'STRING'),
+    bigquery.SchemaField('is_verified', 'BOOLEAN'),
+    bigquery.SchemaField('is_published', 'BOOLEAN'),
+    # Ratings are 0.0-5.0 in 0.1 steps - NUMERIC(2,1) stores and
+    # serializes as a short decimal string instead of an 8-byte float
+    bigquery.SchemaField('rating', 'NUMERIC', precision=2, scale=1),
+    bigquery.SchemaField('review_count', 'INTEGER'),
+    bigquery.SchemaField('has_rating', 'BOOLEAN'),
+    bigquery.SchemaField('place_id', 'STRING'),
+    bigquery.SchemaField('maps_uri', 'STRING'),
+    bigquery.SchemaField('new_review_uri', 'STRING'),
+    bigquery.SchemaField('can_delete', 'BOOLEAN'),
+]
+
+# Schema for the Places rating cache sidecar table
+PLACES_CACHE_SCHEMA = [
+    bigquery.SchemaField('place_id', 'STRING'),
+    bigquery.SchemaField('rating', 'FLOAT'),
+    bigquery.SchemaField('review_count', 'INTEGER'),
+    bigquery.SchemaField('name', 'STRING'),
+    bigquery.SchemaField('fetched_at', 'TIMESTAMP'),
+]
+
+
+# Lazily constructed BigQuery client, shared across warm invocations -
+# each construction opens a fresh gRPC channel and thread pool
+_BQ_CLIENT = None
+
+
+def bq_client():
+    """Return the module-level BigQuery client, creating it on first use"""
+    global _BQ_CLIENT
+    return _BQ_CLIENT or (_BQ_CLIENT := bigquery.Client(project=PROJECT_ID))
+
+
+# Credentials cached across warm invocations - acquiring them fresh costs
+# a metadata-server round trip per request
+_CREDS = None
+_CREDS_REFRESH_MARGIN = timedelta(seconds=60)
 
 
 def get_credentials():
-    """Get Application Default Credentials with proper scopes"""
-    credentials, project = default(scopes=[
-        'https://www.googleapis.com/auth/business.manage'
-    ])
-    
-    if not credentials.valid:
-        credentials.refresh(Request())
-    
-    return credentials
+    """Get Application Default Credentials with proper scopes
+
+    The credentials object is cached at module scope so warm Cloud
+    Function instances reuse the token; it is only refreshed when missing,
+    invalid, or within a minute of expiry.
+    """
+    global _CREDS
+
+    if _CREDS is None:
+        _CREDS, _ = default(scopes=[
+            'https://www.googleapis.com/auth/business.manage'
+        ])
+
+    # google-auth expiry is a naive UTC datetime
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    if not _CREDS.valid or (_CREDS.expiry and _CREDS.expiry - now < _CREDS_REFRESH_MARGIN):
+        _CREDS.refresh(Request())
+
+    return _CREDS
 
 
 def get_all_locations_with_status(credentials):
@@ -41,207 +166,431 @@ def get_all_locations_with_status(credentials):
         'Content-Type': 'application/json'
     }
     
-    read_mask = 'name,title,metadata,storefrontAddress,phoneNumbers,websiteUri'
+    # Nested-field mask: only the metadata subfields and phone number we
+    # actually write to BigQuery, which shrinks each location's JSON
+    # considerably. pageSize 500 is the API maximum - 5x fewer round trips
+    # on the serial pagination
+    read_mask = ('name,title,metadata.hasVoiceOfMerchant,metadata.mapsUri,'
+                 'metadata.placeId,metadata.newReviewUri,metadata.canDelete,'
+                 'storefrontAddress,phoneNumbers.primaryPhone,websiteUri')
     url = 'https://mybusinessbusinessinformation.googleapis.com/v1/accounts/-/locations'
-    params = {'readMask': read_mask, 'pageSize': 100}
+    params = {'readMask': read_mask, 'pageSize': 500}
     
     all_locations = []
-    
-    while True:
-        try:
-            response = requests.get(url, headers=headers, params=params, timeout=30)
-            response.raise_for_status()
-            
-            data = response.json()
-            
+
+    def fetch_page(page_params):
+        response = SESSION.get(url, headers=headers, params=page_params, timeout=30)
+        response.raise_for_status()
+        return orjson.loads(response.content)
+
+    # Single-worker prefetch: request page N+1 as soon as page N's token
+    # arrives, so the network wait overlaps with processing the current page
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        future = prefetcher.submit(fetch_page, dict(params))
+
+        while True:
+            try:
+                data = future.result()
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Error fetching locations: {e}")
+                break
+
+            next_token = data.get('nextPageToken')
+            if next_token:
+                future = prefetcher.submit(fetch_page, {**params, 'pageToken': next_token})
+
             if 'locations' in data:
                 all_locations.extend(data['locations'])
                 logger.info(f"Fetched {len(data['locations'])} locations")
-            
-            if 'nextPageToken' in data:
-                params['pageToken'] = data['nextPageToken']
-            else:
+
+            if not next_token:
                 break
-                
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching locations: {e}")
-            break
-    
+
     return all_locations
 
 
+# Sentinel distinguishing "Places says this place has no data" (cacheable
+# for a week) from a transient failure (worth retrying next run)
+_NO_RATING = object()
+
+
 def get_rating_from_places_api(place_id, api_key):
-    """Get rating using Google Places API"""
+    """Get rating using Places API (New) v1 place details
+
+    The field mask makes the server return only the three fields we
+    store, so the response is a few hundred bytes instead of the legacy
+    endpoint's full details payload. Calls fan out over the shared
+    keep-alive session from the rating thread pool.
+    """
     if not api_key:
         logger.warning("Places API key not configured")
         return None
-    
-    url = 'https://maps.googleapis.com/maps/api/place/details/json'
-    
-    params = {
-        'place_id': place_id,
-        'fields': 'name,rating,user_ratings_total',
-        'key': api_key
+
+    url = f'https://places.googleapis.com/v1/places/{place_id}'
+
+    headers = {
+        'X-Goog-Api-Key': api_key,
+        'X-Goog-FieldMask': 'displayName,rating,userRatingCount'
     }
-    
+
+    _PLACES_BUCKET.acquire()
+
     try:
-        response = requests.get(url, params=params, timeout=10)
+        response = SESSION.get(url, headers=headers, timeout=10)
+
+        # v1 signals bad/unknown place ids via the HTTP status instead of
+        # a body-level status field; 400 and 404 are definitive answers
+        if response.status_code in (400, 404):
+            logger.warning(f"Places API returned {response.status_code} for {place_id}")
+            return _NO_RATING
+
         response.raise_for_status()
-        
-        data = response.json()
-        
-        if data.get('status') == 'OK':
-            result = data.get('result', {})
-            return {
-                'rating': result.get('rating'),
-                'review_count': result.get('user_ratings_total', 0),
-                'name': result.get('name')
-            }
-        else:
-            logger.warning(f"Places API returned status: {data.get('status')}")
-            return None
-            
+
+        data = orjson.loads(response.content)
+
+        return {
+            'rating': data.get('rating'),
+            'review_count': data.get('userRatingCount', 0),
+            'name': (data.get('displayName') or {}).get('text')
+        }
+
     except requests.exceptions.RequestException as e:
         logger.error(f"Error calling Places API for {place_id}: {e}")
         return None
 
 
-def determine_location_status(metadata):
-    """Determine verification and publishing status from metadata"""
-    has_voice_of_merchant = metadata.get('hasVoiceOfMerchant', False)
-    has_maps_uri = bool(metadata.get('mapsUri'))
-    
-    # Verification status
-    verification_status = "VERIFIED" if has_voice_of_merchant else "NOT VERIFIED"
-    
-    # Publishing status
-    publish_status = "PUBLISHED" if has_maps_uri else "NOT PUBLISHED"
-    
-    # Overall status
-    if has_voice_of_merchant and has_maps_uri:
-        overall_status = "ACTIVE - Verified & Published"
-    elif has_voice_of_merchant:
-        overall_status = "CLAIMED - Not Yet Published"
-    elif has_maps_uri:
-        overall_status = "PUBLISHED - Not Claimed"
-    else:
-        overall_status = "INACTIVE - Not Claimed/Published"
-    
-    return {
-        'verification_status': verification_status,
-        'publish_status': publish_status,
-        'overall_status': overall_status,
-        'is_verified': has_voice_of_merchant,
-        'is_published': has_maps_uri
-    }
+def load_places_cache(client):
+    """Load the most recent cached Places result per place_id"""
+    table_ref = f"{PROJECT_ID}.{DATASET_ID}.{PLACES_CACHE_TABLE_ID}"
+
+    query = f"""
+    SELECT place_id, rating, review_count, name, fetched_at
+    FROM `{table_ref}`
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY place_id ORDER BY fetched_at DESC) = 1
+    """
+
+    try:
+        cache = {}
+        for row in client.query(query).result():
+            cache[row.place_id] = {
+                'rating': row.rating,
+                'review_count': row.review_count,
+                'name': row.name,
+                'fetched_at': row.fetched_at
+            }
+        return cache
+
+    except Exception as e:
+        logger.warning(f"Places cache read failed: {e}")
+        return {}
+
+
+def store_places_cache(client, results):
+    """Append freshly fetched Places results to the cache table"""
+    fetched_at = datetime.now(timezone.utc).isoformat()
+
+    rows = [
+        {
+            'place_id': place_id,
+            'rating': result.get('rating'),
+            'review_count': result.get('review_count', 0),
+            'name': result.get('name'),
+            'fetched_at': fetched_at
+        }
+        for place_id, result in results.items() if result
+    ]
+
+    if not rows:
+        return
+
+    table_ref = f"{PROJECT_ID}.{DATASET_ID}.{PLACES_CACHE_TABLE_ID}"
+
+    job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        schema=PLACES_CACHE_SCHEMA,
+    )
+
+    try:
+        client.load_table_from_json(rows, table_ref, job_config=job_config).result()
+    except Exception as e:
+        logger.warning(f"Places cache write failed: {e}")
+
+
+def load_places_denylist(client):
+    """Load place_ids that definitively had no rating within the window"""
+    table_ref = f"{PROJECT_ID}.{DATASET_ID}.{PLACES_DENYLIST_TABLE_ID}"
+
+    query = f"""
+    SELECT place_id
+    FROM `{table_ref}`
+    WHERE last_failed_at > TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {PLACES_DENYLIST_DAYS} DAY)
+    """
+
+    try:
+        return {row.place_id for row in client.query(query).result()}
+    except Exception as e:
+        logger.warning(f"Places denylist read failed: {e}")
+        return set()
+
+
+def store_places_denylist(client, place_ids):
+    """Upsert place_ids that Places reported as having no data"""
+    if not place_ids:
+        return
+
+    table_ref = f"{PROJECT_ID}.{DATASET_ID}.{PLACES_DENYLIST_TABLE_ID}"
+
+    merge_query = f"""
+    MERGE `{table_ref}` T
+    USING UNNEST(@place_ids) AS place_id
+    ON T.place_id = place_id
+    WHEN MATCHED THEN
+      UPDATE SET last_failed_at = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN
+      INSERT (place_id, last_failed_at) VALUES (place_id, CURRENT_TIMESTAMP())
+    """
+
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter('place_ids', 'STRING', place_ids)]
+    )
+
+    try:
+        client.query(merge_query, job_config=job_config).result()
+    except Exception as e:
+        logger.warning(f"Places denylist write failed: {e}")
+
+
+def fetch_all_ratings(locations, api_key):
+    """Fetch Places ratings for every location, cache-first
+
+    Ratings move slowly, so entries younger than PLACES_CACHE_FRESH_HOURS
+    are served straight from the cache table. Entries in the
+    stale-while-revalidate window are used for this run but re-fetched so
+    the next run sees them fresh. Only misses block on the Places API,
+    through the bounded thread pool. Returns a dict keyed by place_id.
+    """
+    ratings = {}
+
+    if not api_key:
+        return ratings
+
+    place_ids = {loc.get('metadata', {}).get('placeId') for loc in locations}
+    place_ids.discard(None)
+
+    if not place_ids:
+        return ratings
+
+    client = bq_client()
+    cache = load_places_cache(client)
+    denylist = load_places_denylist(client)
+    now = datetime.now(timezone.utc)
+
+    to_fetch = []       # No usable cache entry; this run blocks on the result
+    to_revalidate = []  # Stale entry served now, refreshed for the next run
+    denied = 0
+
+    for place_id in place_ids:
+        # Known no-data place_ids skip the network entirely - the answer
+        # would just be NOT_FOUND again
+        if place_id in denylist:
+            denied += 1
+            continue
+
+        entry = cache.get(place_id)
+
+        if entry is not None:
+            age_hours = (now - entry['fetched_at']).total_seconds() / 3600
+
+            if age_hours < PLACES_CACHE_STALE_HOURS:
+                ratings[place_id] = {
+                    'rating': entry['rating'],
+                    'review_count': entry['review_count'],
+                    'name': entry['name']
+                }
+
+                if age_hours >= PLACES_CACHE_FRESH_HOURS:
+                    to_revalidate.append(place_id)
+
+                continue
+
+        to_fetch.append(place_id)
+
+    fresh_results = {}
+
+    if to_fetch or to_revalidate:
+        with ThreadPoolExecutor(max_workers=PLACES_CONCURRENCY) as executor:
+            futures = {
+                executor.submit(get_rating_from_places_api, place_id, api_key): place_id
+                for place_id in to_fetch + to_revalidate
+            }
+
+            newly_denied = []
+            for future in as_completed(futures):
+                place_id = futures[future]
+                result = future.result()
+
+                if result is _NO_RATING:
+                    newly_denied.append(place_id)
+                    result = None
+
+                fresh_results[place_id] = result
+
+        # Live results only feed this run's rows for cache misses;
+        # revalidated entries were already served stale
+        for place_id in to_fetch:
+            ratings[place_id] = fresh_results.get(place_id)
+
+        store_places_cache(client, fresh_results)
+        store_places_denylist(client, newly_denied)
+
+    hits = len(place_ids) - len(to_fetch) - denied
+    logger.info(f"Places cache: {hits}/{len(place_ids)} served from cache "
+                f"({len(to_revalidate)} refreshed in background, "
+                f"{denied} skipped via denylist)")
+
+    return ratings
 
 
 def transform_to_bigquery_rows(locations, api_key):
     """Transform location data to BigQuery-ready rows"""
     rows = []
-    current_timestamp = datetime.utcnow()
+    # Aware UTC timestamp, serialized once - utcnow() is deprecated and
+    # its naive isoformat() lets BigQuery guess the zone
+    current_timestamp = datetime.now(timezone.utc)
+    ts_iso = current_timestamp.isoformat().replace('+00:00', 'Z')
     check_date = current_timestamp.date().isoformat()
-    
+
+    # Fetch all ratings up front in parallel, then assemble rows serially
+    ratings_by_place_id = fetch_all_ratings(locations, api_key)
+
+    # Per-row logging at scale is pure overhead (each line is a JSON
+    # encode + stderr flush on the Cloud Functions log sink), so report
+    # progress at ~1% granularity and summarize ratings once at the end
+    total = len(locations)
+    log_every = max(1, total // 100)
+    rated_count = 0
+
     for idx, loc in enumerate(locations, 1):
-        metadata = loc.get('metadata', {})
-        
-        # Get status information
-        status_info = determine_location_status(metadata)
-        
+        metadata = loc.get('metadata') or {}
+
+        # Status flags inlined as locals - building the intermediate
+        # status dict per row costs more than the row itself at scale
+        has_vom = bool(metadata.get('hasVoiceOfMerchant'))
+        has_maps = bool(metadata.get('mapsUri'))
+
+        if has_vom and has_maps:
+            overall_status = "ACTIVE - Verified & Published"
+        elif has_vom:
+            overall_status = "CLAIMED - Not Yet Published"
+        elif has_maps:
+            overall_status = "PUBLISHED - Not Claimed"
+        else:
+            overall_status = "INACTIVE - Not Claimed/Published"
+
         title = loc.get('title', 'N/A')
-        place_id = metadata.get('placeId')
-        
-        logger.info(f"[{idx}/{len(locations)}] Processing {title}")
-        
+        place_id = metadata.get('placeId') or ''
+
+        if idx % log_every == 0 or idx == total:
+            logger.info(f"[{idx}/{total}] Processing locations...")
+
         # Get rating data from Places API
         rating = None
         review_count = 0
-        
+
         if place_id and api_key:
-            rating_data = get_rating_from_places_api(place_id, api_key)
-            
+            rating_data = ratings_by_place_id.get(place_id)
+
             if rating_data:
                 rating = rating_data.get('rating')
                 review_count = rating_data.get('review_count', 0)
-                logger.info(f"  ✅ Rating: {rating}⭐ ({review_count} reviews)")
-            else:
-                logger.warning(f"  ⚠️ Could not fetch rating")
-        else:
-            logger.warning(f"  ⚠️ No Place ID or API key")
-        
+                rated_count += 1
+
+        # Structured address - queryable STRUCT fields instead of a
+        # Python repr string
+        addr = loc.get('storefrontAddress') or {}
+
         # Build row
         row = {
             'check_date': check_date,
-            'check_timestamp': current_timestamp.isoformat(),
+            'check_timestamp': ts_iso,
             'title': title,
             'location_id': loc.get('name', 'N/A'),
             'phone': loc.get('phoneNumbers', {}).get('primaryPhone', ''),
             'website': loc.get('websiteUri', ''),
-            'address': str(loc.get('storefrontAddress', {})),
+            'address': {
+                'locality': addr.get('locality'),
+                'region_code': addr.get('regionCode'),
+                'postal_code': addr.get('postalCode'),
+                'address_lines': addr.get('addressLines', [])
+            },
             
             # Status Information
-            'overall_status': status_info['overall_status'],
-            'verification_status': status_info['verification_status'],
-            'publish_status': status_info['publish_status'],
-            'is_verified': status_info['is_verified'],
-            'is_published': status_info['is_published'],
+            'overall_status': overall_status,
+            'verification_status': "VERIFIED" if has_vom else "NOT VERIFIED",
+            'publish_status': "PUBLISHED" if has_maps else "NOT PUBLISHED",
+            'is_verified': has_vom,
+            'is_published': has_maps,
             
             # Rating Information
-            'rating': rating if rating is not None else 0.0,
+            'rating': f"{rating if rating is not None else 0.0:.1f}",
             'review_count': review_count,
             'has_rating': rating is not None,
             
             # Metadata
-            'place_id': place_id if place_id else '',
+            'place_id': place_id,
             'maps_uri': metadata.get('mapsUri', ''),
             'new_review_uri': metadata.get('newReviewUri', ''),
             'can_delete': metadata.get('canDelete', False),
         }
         
         rows.append(row)
-    
+
+    logger.info(f"✅ Ratings attached for {rated_count}/{total} location(s)")
+
     return rows
 
 
-def write_to_bigquery(rows):
-    """Write rows to BigQuery with date-based replacement"""
+def write_to_bigquery(rows, stats=None):
+    """Replace today's partition of the status table with the new snapshot
+
+    stats, if given, is the summary dict main() already computed - logged
+    here instead of re-iterating the row list.
+    """
     if not rows:
         logger.warning("No rows to write to BigQuery")
         return
-    
-    client = bigquery.Client(project=PROJECT_ID)
+
+    client = bq_client()
     table_ref = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
-    
+
+    # One atomic load into the day's partition (table$YYYYMMDD with
+    # WRITE_TRUNCATE) replaces the old DELETE + append: no DML table scan,
+    # no window where the day's records are missing. Requires the table to
+    # be partitioned by check_date (DAY); the TimePartitioning config
+    # creates it that way on first run
+    check_date = rows[0]['check_date']
+    destination = f"{table_ref}${check_date.replace('-', '')}"
+
+    job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        schema=STATUS_SCHEMA,
+        time_partitioning=bigquery.TimePartitioning(field='check_date'),
+    )
+
     try:
-        # Delete existing records for today
-        check_date = rows[0]['check_date']
-        
-        delete_query = f"""
-        DELETE FROM `{table_ref}`
-        WHERE check_date = '{check_date}'
-        """
-        
-        logger.info(f"Deleting existing records for {check_date}")
-        client.query(delete_query).result()
-        
-        # Insert new records
-        logger.info(f"Inserting {len(rows)} new records")
-        errors = client.insert_rows_json(table_ref, rows)
-        
-        if errors:
-            logger.error(f"BigQuery insert errors: {errors}")
-            raise Exception(f"Failed to insert rows: {errors}")
-        
+        logger.info(f"Replacing partition {check_date} with {len(rows)} records")
+        client.load_table_from_json(rows, destination, job_config=job_config).result()
+
         logger.info(f"Successfully wrote {len(rows)} rows to BigQuery")
-        
-        # Log summary statistics
-        verified_count = sum(1 for r in rows if r['is_verified'])
-        published_count = sum(1 for r in rows if r['is_published'])
-        with_ratings = sum(1 for r in rows if r['has_rating'])
-        avg_rating = sum(r['rating'] for r in rows if r['has_rating']) / with_ratings if with_ratings > 0 else 0
-        
-        logger.info(f"Summary: {verified_count} verified, {published_count} published, {with_ratings} with ratings (avg: {avg_rating:.2f})")
-        
+
+        if stats:
+            logger.info(f"Summary: {stats['verified_count']} verified, "
+                        f"{stats['published_count']} published, "
+                        f"{stats['with_ratings']} with ratings "
+                        f"(avg: {stats['avg_rating']:.2f})")
+
     except Exception as e:
         logger.error(f"BigQuery write error: {e}")
         raise
@@ -280,17 +629,30 @@ def main(request=None):
         logger.info("Processing locations and fetching ratings...")
         rows = transform_to_bigquery_rows(locations, PLACES_API_KEY)
         
-        # Write to BigQuery
+        # Calculate summary stats in a single pass over the rows
+        verified_count = published_count = with_ratings = total_reviews = 0
+        rating_sum = 0.0
+
+        for r in rows:
+            verified_count += r['is_verified']
+            published_count += r['is_published']
+            total_reviews += r['review_count']
+
+            if r['has_rating']:
+                with_ratings += 1
+                rating_sum += float(r['rating'])
+
+        avg_rating = rating_sum / with_ratings if with_ratings > 0 else 0
+
+        # Write to BigQuery, handing down the stats already computed
         logger.info("Writing to BigQuery...")
-        write_to_bigquery(rows)
-        
-        # Calculate summary stats
-        verified_count = sum(1 for r in rows if r['is_verified'])
-        published_count = sum(1 for r in rows if r['is_published'])
-        with_ratings = sum(1 for r in rows if r['has_rating'])
-        avg_rating = sum(r['rating'] for r in rows if r['has_rating']) / with_ratings if with_ratings > 0 else 0
-        total_reviews = sum(r['review_count'] for r in rows)
-        
+        write_to_bigquery(rows, stats={
+            'verified_count': verified_count,
+            'published_count': published_count,
+            'with_ratings': with_ratings,
+            'avg_rating': avg_rating,
+        })
+
         logger.info("="*70)
         logger.info("✅ Location status & ratings collection complete!")
         logger.info(f"Total locations: {len(rows)}")